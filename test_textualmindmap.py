@@ -0,0 +1,61 @@
+import io
+import pytest
+import graphviz as gv
+from textualmindmap import DotWriter, GraphvizBackend, GVNode, Node, Parser
+
+names = ['plain', 'two words', 'node', '-4.2', '<<b>html</b>>',
+         'say "hi"', 'say \\\\"hi']
+
+def build(graphfn, quote):
+  # issue the same statements to a graphviz.Graph and a DotWriter
+  graph = graphfn('root', comment='root comment', strict=True,
+                  graph_attr=dict(rankdir='LR'), node_attr=dict(shape='box'))
+  graph.attr(label='mind map')
+  outer = graphfn('cluster outer', comment='outer comment', edge_attr=dict(color='blue'))
+  inner = graphfn(None)
+  for i, name in enumerate(names):
+    target = (graph, outer, inner)[i % 3]
+    target.node(quote(name), 'label ' + name if i % 2 else None, color='red', fontsize=None)
+  inner.attr(style='filled')
+  outer.subgraph(inner)
+  graph.subgraph(outer)
+  for tail, head in zip(names, names[1:]):
+    graph.edge(quote(tail), quote(head))
+  graph.edge(quote(names[0]), quote(names[-1]), weight='0.01', style='dashed')
+  return graph
+
+def test_dotwriter_matches_graphviz():
+  # graphviz.Graph quotes node names itself, DotWriter expects quoted ids
+  expected = build(gv.Graph, lambda name: name).source
+  assert build(DotWriter, DotWriter.quote).source() == expected
+
+def test_dotwriter_rejects_unknown_options():
+  DotWriter('g', format='svg', engine='neato')
+  with pytest.raises(TypeError):
+    DotWriter('g', lable='typo')
+
+def test_dotwriter_rejects_strict_subgraph():
+  with pytest.raises(ValueError):
+    DotWriter('g').subgraph(DotWriter('s', strict=True))
+
+def test_render_matches_graphviz():
+  source = '* (r) Root\n  - Alpha -- Beta\n    + a child\n  - Beta\n- Second root\n'
+  root = Parser(GVNode, Node.addchild).parse(io.StringIO(source))[0]
+  backend = GraphvizBackend(root, format='svg')
+  beta = next(n for n in root.dfsiter() if n.text() == 'Beta')
+  backend.group([beta], name='cluster_b', comment='group', graph_attr=dict(color='blue'))
+  rendered = backend.render()
+  graph = gv.Graph('grouproot', format='svg')
+  for name in ['root', 'Root', 'Alpha', 'a child', 'Second root']:
+    graph.node(name)
+  group = gv.Graph('cluster_b', comment='group', graph_attr=dict(color='blue'))
+  group.node('Beta')
+  graph.subgraph(group)
+  graph.edge('root', 'Root')
+  graph.edge('Root', 'Alpha')
+  graph.edge('Alpha', 'Beta', color='red', style='dashed', weight='0.01')
+  graph.edge('Alpha', 'a child')
+  graph.edge('Root', 'Beta')
+  graph.edge('root', 'Second root')
+  assert rendered.source == graph.source
+  assert rendered.format == 'svg'
@@ -1,7 +1,12 @@
 import re
-import itertools
+from array import array
+from collections import deque
+from types import MappingProxyType
 import graphviz as gv
 
+# shared read-only stand-in for attribute dicts that were never written
+_EMPTY = MappingProxyType({})
+
 class InvalideSyntaxError(Exception):
   def __str__(self):
     return 'Invalide node specification'
@@ -12,27 +17,25 @@ class RedefinedIdentifierError(Exception):
     return 'Redefined identifier ' + self._identifier
 
 class Node:
-  tmmpattern = r'''
-  (\((?P<id>[\w\.]+)\))?      # (optional) parentheses enclosed id
-  \s*                         # (optional) sperating spaces
-  (\[(?P<tags>[\w\.,]+)\])?   # (optional) brakets enclosed tags
-  \s*                         # (optional) sperating spaces
-  (?P<text>.+)                # (requried) node text'''
-  tmmregex = re.compile(tmmpattern, re.VERBOSE)
+  __slots__ = ('_text', '_identifier', '_tags', '_parent', '_children',
+               '_level', '_index', '_attributes')
+  # (optional) parentheses enclosed id, (optional) brakets enclosed tags,
+  # (requried) node text, separated by (optional) spaces
+  tmmpattern = r'\A(?:\((?P<id>[\w.]+)\))?\s*(?:\[(?P<tags>[\w.,]+)\])?\s*(?P<text>.+)\Z'
+  tmmregex = re.compile(tmmpattern)
   def __init__(self, text):
-    match = self.tmmregex.fullmatch(text)
+    match = self.tmmregex.match(text)
     if not match:
       raise InvalideSyntaxError()
-    self._text = match.group('text')
-    self._identifier = match.group('id')
-    self._tags = set()
-    if match.group('tags'):
-      self._tags = match.group('tags').split(',')
+    text, identifier, tags = match.group('text', 'id', 'tags')
+    self._text = text
+    self._identifier = identifier
+    self._tags = tags.split(',') if tags else set()
     self._parent = None
     self._children = []
     self._level = 0
     self._index = 0
-    self._attributes = dict()
+    self._attributes = None
   def __str__(self):
     return self._text
   # getters
@@ -45,14 +48,16 @@ class Node:
   def parent(self):
     return self._parent;
   def attributes(self):
+    if self._attributes is None:
+      self._attributes = dict()
     return self._attributes
   # child add/remove
   def attach(self, parent, update=False):
     assert self._parent is None
     self._parent = parent
     self._parent._children.append(self)
+    self._index = len(parent._children)-1
     if update:
-      self._index = len(parent._children)-1
       for c in self.dfsiter():
         c._level = c._parent._level+1
   def detach(self, update=False):
@@ -84,54 +89,54 @@ class Node:
   def childiter(self):
     return iter(self._children)
   def siblingiter(self):
-    if self._parent:
-      for n in self._parent.children:
-        if self != n:
-          yield n
+    if not self._parent:
+      return iter(())
+    return (n for n in self._parent._children if n is not self)
   def ancestoriter(self):
     node = self._parent
     while node:
       yield node
       node = node._parent
   def bfsiter(self):
-    current = [self]
-    while current:
-      for n in current:
-        yield n
-      next = itertools.chain.from_iterable(n.childiter() for n in current)
-      current = list(next)
+    queue = deque((self,))
+    while queue:
+      node = queue.popleft()
+      yield node
+      queue.extend(node._children)
   def descendantiter(self):
-    return itertools.chain.from_iterable(c.dfsiter() for c in self.childiter())
+    it = self.dfsiter()
+    next(it)
+    yield from it
   def dfsiter(self):
-    yield self
-    for n in self.descendantiter():
-      yield n
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      yield node
+      stack.extend(reversed(node._children))
   # update topology
   def canonicalize(self):
+    # _index is kept up to date by attach and detach
     if self._parent:
-      self._level = c._parent._level+1
-      self._index = self._parent._children.index(self)
+      self._level = self._parent._level+1
     else:
       self._level = 0
       self._index = 0
-    for c in self.descendantiter():
-      c._level = c._parent._level+1
-    for n in itertools.takewhile(lambda n: not n.leaf(), self.dfsiter()):
-      for i, c in enumerate(n._children):
+    queue = deque((self,))
+    while queue:
+      node = queue.popleft()
+      level = node._level+1
+      for i, c in enumerate(node._children):
+        c._level = level
         c._index = i
+      queue.extend(node._children)
 
 class Parser:
-  nodepattern = r'''\A(?P<indent>[\s]*)     # (optional) leading spaces
-                    [\*\-\+]                # (required) bullet 
-                    \s*                     # (optional) sperating spaces
-                    (?P<text>.+)            # (requried) node text
-                    \n?\Z                   # (optional) end of line'''
-  commentpattern = r'''\A(?P<indent>[\s]*)  # (optional) leading spaces
-                       \#                   # (required) comment mark
-                       (?P<text>.+)         # (requried) comment text
-                       \n?\Z                # (optional) end of line'''
-  noderegex = re.compile(nodepattern, re.VERBOSE)
-  commentregex = re.compile(commentpattern, re.VERBOSE)
+  # each line of the source: (optional) leading spaces, then either a comment,
+  # a bullet followed by the node text, any other (invalid) text, or nothing
+  # at all for blank lines; trailing spaces of the node text are stripped by
+  # parse, a lazy text group would retry the line end at every character
+  linepattern = r'(?m)^(?P<indent>[^\S\n]*)(?:#.*|[\*\-\+][^\S\n]*(?P<text>.+)|(?P<invalid>.+))?$'
+  lineregex = re.compile(linepattern)
   # interface
   def __init__(self, nodefn, edgefn, singleroot = 'root'):
     ''' 
@@ -145,26 +150,26 @@ class Parser:
     self._singleroot = singleroot
   def parse(self, fileobj):
     roots = []
-    for line in fileobj:
-      if line.isspace():
-        continue
-      match = self.commentregex.fullmatch(line)
-      if match:
+    # bind the hot loop's lookups to locals
+    nodefn = self._nodefn
+    edgefn = self._edgefn
+    stack = self._stack
+    for match in self.lineregex.finditer(fileobj.read()):
+      kind = match.lastgroup
+      if kind != 'text':
+        if kind == 'invalid':
+          raise InvalideSyntaxError()
         continue
-      match = self.noderegex.fullmatch(line)
-      if not match:
-        raise InvalideSyntaxError()
-      indent = len(match.group('indent'))
-      text = match.group('text')
-      node = self._nodefn(text)
-      while self._stack and self._stack[-1][1] >= indent:
-        n, i = self._stack.pop()
-      if self._stack:
-        parent, _ = self._stack[-1]
-        self._edgefn(parent, node)
+      text = match.group('text').rstrip()
+      indent = match.end('indent') - match.start()
+      node = nodefn(text)
+      while stack and stack[-1][1] >= indent:
+        stack.pop()
+      if stack:
+        edgefn(stack[-1][0], node)
       else:
         roots.append(node)
-      self._stack.append((node, indent))
+      stack.append((node, indent))
     if len(roots) > 1 and self._singleroot:
       pseudoroot = self._nodefn(self._singleroot)
       for root in roots:
@@ -189,11 +194,14 @@ class UnresolvedTargetError(Exception):
     return 'Unresolved target ' + self._targetname
 
 class GVNode(Node):
+  __slots__ = ('_attrs', '_edgeattrs', '_group', '_seq', '_islink', '_targets')
   def __init__(self, text, **kwargs):
     super().__init__(text)
     self._attrs = kwargs
-    self._edgeattrs = dict()
+    self._edgeattrs = None
     self._group=None
+    self._seq = -1
+    self._islink = False
     self._targets = []
     index = self._text.find('--')
     if index != -1:
@@ -202,25 +210,35 @@ class GVNode(Node):
   def attr(self, **kwargs):
     self._attrs.update(kwargs)
   def edgeattr(self, **kwargs):
+    if self._edgeattrs is None:
+      self._edgeattrs = dict()
     self._edgeattrs.update(kwargs)
   def targetiter(self):
     return iter(self._targets)
   def addtarget(self, node):
     self._targets.append(node)
 class GVGroup(Node):
+  __slots__ = ('_attrs', '_groupattrs', '_graph')
   def __init__(self, name, **kwargs):
     super().__init__(name)
     self._attrs = kwargs
-    self._groupattrs = dict()
+    self._groupattrs = None
     self._graph = None
   def attr(self, **kwargs):
     self._attrs.update(kwargs)
   def groupattr(self, **kwargs):
+    if self._groupattrs is None:
+      self._groupattrs = dict()
     self._groupattrs.update(kwargs)
   def postdfsiter(self):
-    for n in itertools.chain.from_iterable(c.postdfsiter() for c in self.childiter()):
-      yield n
-    yield self
+    stack = [(self, False)]
+    while stack:
+      node, visited = stack.pop()
+      if visited:
+        yield node
+      else:
+        stack.append((node, True))
+        stack.extend((c, False) for c in reversed(node._children))
   def commonancestor(self, other):
     assert self != other
     ancestors = set(self.ancestoriter())
@@ -229,11 +247,99 @@ class GVGroup(Node):
         return g
     assert False
 
+class DotWriter:
+  '''
+  Writes undirected graphviz DOT source straight into a list of lines,
+  following the layout of graphviz.Graph; node and edge statements take
+  node ids that are already quoted by quote()
+  '''
+  # identifier quoting and escaping of graphviz itself
+  quote = staticmethod(gv.quoting.quote)
+  # keyword arguments of graphviz.Source
+  sourceoptions = frozenset(('filename', 'directory', 'format', 'engine',
+                             'encoding', 'renderer', 'formatter'))
+  def __init__(self, name=None, comment=None, graph_attr=None, node_attr=None,
+               edge_attr=None, strict=False, **options):
+    '''
+    options are passed to graphviz.Source when rendering (format, engine...)
+    '''
+    unknown = options.keys() - self.sourceoptions
+    if unknown:
+      raise TypeError('unexpected keyword arguments: ' + ', '.join(sorted(unknown)))
+    self._name = name
+    self._comment = comment
+    self._strict = strict
+    self._options = options
+    self._body = []
+    self._attrlists = dict()
+    for kw, attrs in (('graph', graph_attr), ('node', node_attr), ('edge', edge_attr)):
+      if attrs:
+        self._body.append('\t{} [{}]\n'.format(kw, self.attrlist(attrs)))
+  def attrlist(self, attrs):
+    if not attrs:
+      return ''
+    # attribute dicts repeat across statements, format each one once
+    key = tuple(attrs.items())
+    attrlist = self._attrlists.get(key)
+    if attrlist is None:
+      quote = self.quote
+      attrlist = ' '.join(quote(k) + '=' + quote(v) for k, v in sorted(attrs.items()) if v is not None)
+      self._attrlists[key] = attrlist
+    return attrlist
+  # graph statements
+  def attr(self, **attrs):
+    if attrs:
+      self._body.append('\t' + self.attrlist(attrs) + '\n')
+  def node(self, nodeid, label=None, **attrs):
+    attrlist = self.attrlist(attrs)
+    if label is not None:
+      label = 'label=' + self.quote(label)
+      attrlist = label + ' ' + attrlist if attrlist else label
+    if attrlist:
+      self._body.append('\t{} [{}]\n'.format(nodeid, attrlist))
+    else:
+      self._body.append('\t' + nodeid + '\n')
+  def edge(self, tailid, headid, **attrs):
+    attrlist = self.attrlist(attrs)
+    if attrlist:
+      self._body.append('\t{} -- {} [{}]\n'.format(tailid, headid, attrlist))
+    else:
+      self._body.append('\t' + tailid + ' -- ' + headid + '\n')
+  def subgraph(self, graph):
+    if graph._strict:
+      raise ValueError('subgraphs cannot be strict')
+    if graph._comment:
+      self._body.append('\t// ' + graph._comment + '\n')
+    if graph._name is None:
+      self._body.append('\t{\n')
+    else:
+      self._body.append('\tsubgraph ' + self.quote(graph._name) + ' {\n')
+    self._body.extend('\t' + line for line in graph._body)
+    self._body.append('\t}\n')
+    # only the root graph is rendered, drop the nested graph's options
+    graph._options = _EMPTY
+  # output
+  def source(self):
+    head = []
+    if self._comment:
+      head.append('// ' + self._comment + '\n')
+    head.append('strict graph ' if self._strict else 'graph ')
+    if self._name is not None:
+      head.append(self.quote(self._name) + ' ')
+    head.append('{\n')
+    return ''.join(head) + ''.join(self._body) + '}\n'
+  def tosource(self):
+    return gv.Source(self.source(), **self._options)
+
 class GraphvizBackend:
   def __init__(self, root, **kwargs):
     self._root = root
     self._grouproot = GVGroup('grouproot', **kwargs)
     self._passes = []
+    self._nodes = []
+    self._ids = []
+    self._texts = []
+    self._parents = array('i')
     self._identifiednodes = dict()
     self.linkpredicate = lambda _: False
     self.nodenamefn = Node.text
@@ -262,25 +368,29 @@ class GraphvizBackend:
       self._identifiednodes[node.identifier()] = node
   # collect link  op
   def collectlinkop(self, node):
-    if not self.linkpredicate(node):
+    # evaluate the predicate once, later ops read the cached flag
+    node._islink = self.linkpredicate(node)
+    if not node._islink:
+      # link nodes are detached, later passes only visit the remaining nodes
+      self._nodes.append(node)
       return
     if node._children:
       raise TargetNodeError(node)
-    node.parent().addtarget((node.text(), node._edgeattrs))
+    node.parent().addtarget((node.text(), node._edgeattrs or _EMPTY))
     node.detach(update=True)
   # resolve link op
   def _resolvelinkbytext(self, targetname, fullmatch=True):
     if fullmatch:
-      matched = [n for n in self._root.dfsiter() if n.text() == targetname]
+      matched = [n for n in self._nodes if n.text() == targetname]
     else:
-      matched = [n for n in self._root.dfsiter() if n.text.startswith(targetname)]
+      matched = [n for n in self._nodes if n.text.startswith(targetname)]
     if not matched:
       return None
     if len(matched) > 1:
       raise AmbitiousTargetError(node.text())
     return matched[0]
   def resolvelinkop(self, node):
-    assert not self.linkpredicate(node)
+    assert not node._islink
     targetnodes = []
     for targetname, targetattrs in node.targetiter():
       target = None
@@ -298,55 +408,83 @@ class GraphvizBackend:
   def groupnodeop(self, node):
     if not node._group:
       node._group = self._grouproot
+  # index node op
+  def indexnodeop(self, node):
+    # parents are visited first, their sequence numbers are already assigned
+    node._seq = len(self._ids)
+    text = node._text
+    name = text if self.nodenamefn is Node.text else self.nodenamefn(node)
+    # quote each node name once, the DOT statements reuse the quoted id
+    self._ids.append(DotWriter.quote(name))
+    self._texts.append(text)
+    self._parents.append(node._parent._seq if node._parent else -1)
   # create graph op
   def creategraphop(self, group):
-    group._graph = gv.Graph(group.text(), **group._attrs)
-    group._graph.attr(**group._groupattrs)
+    group._graph = DotWriter(group.text(), **group._attrs)
+    group._graph.attr(**(group._groupattrs or _EMPTY))
   # render node opeartion
   def rendernodeop(self, node):
-    assert not self.linkpredicate(node)
-    name = self.nodenamefn(node)
+    assert not node._islink
+    seq = node._seq
+    nodeid = self._ids[seq]
     label = None
     if not self.nodenamefn is Node.text:
-      label = node.text()
+      label = self._texts[seq]
     assert node._group and node._group._graph
-    node._group._graph.node(name, label, **node._attrs)
+    node._group._graph.node(nodeid, label, **node._attrs)
   # assemble graph op
   def assemblegraphop(self, group):
     if group.parent():
       group.parent()._graph.subgraph(group._graph)
   # render edge operation
   def renderedgeop(self, node):
-    assert not self.linkpredicate(node)
-    if not node.parent():
+    assert not node._islink
+    seq = node._seq
+    parentseq = self._parents[seq]
+    if parentseq < 0:
       return
-    parent = node.parent()
-    headname = self.nodenamefn(node)
-    tailname = self.nodenamefn(parent)
+    headid = self._ids[seq]
+    tailid = self._ids[parentseq]
     # add edge to the root graph
-    self._grouproot._graph.edge(tailname, headname, **node._edgeattrs)
+    self._grouproot._graph.edge(tailid, headid, **(node._edgeattrs or _EMPTY))
   # extra edge operation
   def extraedgeop(self, node):
-    tailname = self.nodenamefn(node)
+    tailid = self._ids[node._seq]
     for target, edgeattrs in node.targetiter():
-      headname = self.nodenamefn(target)
-      attrs = self.extraedgeattrs.copy()
-      attrs.update(edgeattrs)
-      self._grouproot._graph.edge(tailname, headname, **attrs)
+      # identified link nodes may be targets although they are not indexed
+      if target._seq < 0:
+        headid = DotWriter.quote(self.nodenamefn(target))
+      else:
+        headid = self._ids[target._seq]
+      attrs = {**self.extraedgeattrs, **edgeattrs}
+      self._grouproot._graph.edge(tailid, headid, **attrs)
+
+  # fused per-node ops, each runs several ops during a single walk
+  def collectop(self, node):
+    self.collectnodeidop(node)
+    self.collectlinkop(node)
+  def nodeop(self, node):
+    self.resolvelinkop(node)
+    self.groupnodeop(node)
+    self.indexnodeop(node)
+    self.rendernodeop(node)
+  def edgeop(self, node):
+    self.renderedgeop(node)
+    self.extraedgeop(node)
 
   def _populatestdpasses(self):
-    self._passes.append((self.collectnodeidop, self._root.dfsiter()))
-    self._passes.append((self.collectlinkop, self._root.dfsiter()))
-    self._passes.append((self.resolvelinkop, self._root.dfsiter()))
-    self._passes.append((self.groupnodeop, self._root.dfsiter()))
-    self._passes.append((self.creategraphop, self._grouproot.dfsiter()))
-    self._passes.append((self.rendernodeop, self._root.dfsiter()))
-    self._passes.append((self.assemblegraphop, self._grouproot.postdfsiter()))
-    self._passes.append((self.renderedgeop, self._root.dfsiter()))
-    self._passes.append((self.extraedgeop, self._root.dfsiter()))
+    # walk each tree once, the passes iterate over the cached orders
+    nodes = list(self._root.dfsiter())
+    groups = list(self._grouproot.dfsiter())
+    postgroups = list(self._grouproot.postdfsiter())
+    self._passes.append((self.creategraphop, groups))
+    self._passes.append((self.collectop, nodes))
+    self._passes.append((self.nodeop, self._nodes))
+    self._passes.append((self.assemblegraphop, postgroups))
+    self._passes.append((self.edgeop, self._nodes))
   def render(self):
     self._populatestdpasses()
     for op, it in self._passes:
       for n in it:
         op(n)
-    return self._grouproot._graph
+    return self._grouproot._graph.tosource()